@@ -4,14 +4,20 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-def get_tokenized_tokens(words, tokenizer):
+def get_tokenized_tokens(words, tokenizer, cache=None):
+    """`cache` (optional) is a dict from a word to its sub tokens, shared between calls with the same tokenizer."""
     all_tokens = []    
     tok_to_orig_index = []
     orig_to_tok_index = []
 
     for i, token in enumerate(words):
         orig_to_tok_index.append(len(all_tokens))            
-        sub_tokens = tokenizer.tokenize(token)
+        if cache is None:
+            sub_tokens = tokenizer.tokenize(token)
+        else:
+            sub_tokens = cache.get(token)
+            if sub_tokens is None:
+                sub_tokens = cache[token] = tokenizer.tokenize(token)
         for sub_token in sub_tokens:
             all_tokens.append(sub_token)
             tok_to_orig_index.append(i)
@@ -16,12 +16,16 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+import contextlib
+import hashlib
 import io
 import logging
 import os
 import random
+import re
 import sys
-from collections import defaultdict, namedtuple
+from collections import defaultdict
+from functools import lru_cache, partial
 
 import numpy as np
 import torch
@@ -43,6 +47,28 @@ logger = logging.getLogger(__name__)
 # for POS list
 POS = {}
 REV_POS = {}
+# (hinsi, bunrui) -> POS; bunrui is '*' for entries without a bunrui
+POS_KEY = {}
+
+# str.translate table equivalent to zenhan.h2z for single characters (built on first use)
+H2Z_TABLE = None
+
+
+def convert_h2z(word):
+    """Convert hankaku characters in a word to zenkaku in the same way as zenhan.h2z."""
+    global H2Z_TABLE
+    import zenhan
+    # a hankaku kana followed by a (han)dakuten may become one zenkaku character
+    if '\uff9e' in word or '\uff9f' in word:
+        return zenhan.h2z(word)
+    if H2Z_TABLE is None:
+        # zenhan only converts ASCII and hankaku kana/symbols, one character to one character
+        H2Z_TABLE = {}
+        for code in list(range(0x20, 0x7f)) + list(range(0xff61, 0xffa0)):
+            converted = zenhan.h2z(chr(code))
+            if converted != chr(code):
+                H2Z_TABLE[code] = converted
+    return word.translate(H2Z_TABLE)
 
 
 class ParsingExample(object):
@@ -56,10 +82,13 @@ class ParsingExample(object):
                  heads=None,
                  token_tags=None,
                  comment=None,
-                 h2z=False):
+                 h2z=False,
+                 line_cols=None):
         self.example_id = example_id
         self.words = words
         self.lines = lines
+        # columns of each line, split once on reading
+        self.line_cols = line_cols if line_cols is not None else [tuple(line.split("\t")) for line in lines]
         self.knp_string = knp_string
         self.heads = heads
         self.token_tags = token_tags
@@ -68,10 +97,9 @@ class ParsingExample(object):
         self.h2z = h2z
 
         if self.h2z is True:
-            from copy import deepcopy
-            import zenhan
-            self.words_orig = deepcopy(self.words)
-            self.words = [zenhan.h2z(word) for word in words]
+            # the original list is not modified, so it does not need to be copied
+            self.words_orig = self.words
+            self.words = [convert_h2z(word) for word in words]
 
     def __str__(self):
         return self.__repr__()
@@ -92,17 +120,21 @@ class TokenLabelVocabulary(object):
         self.label_to_index = {}
         self.index_to_label = []
 
-        self.read_examples(train_examples)
-        self.add_indices(train_examples)
-
-    def read_examples(self, train_examples):
+        # build the vocabulary and index the training examples in a single pass
+        label_to_index = self.label_to_index
+        index_to_label = self.index_to_label
         for train_example in train_examples:
+            indices = []
             for tag in train_example.token_tags[self.namespace]:
                 if tag == -1:
+                    indices.append(-1)
                     continue
-                if tag not in self.label_to_index:
-                    self.label_to_index[tag] = len(self.index_to_label)
-                    self.index_to_label.append(tag)
+                index = label_to_index.get(tag)
+                if index is None:
+                    index = label_to_index[tag] = len(index_to_label)
+                    index_to_label.append(tag)
+                indices.append(index)
+            train_example.token_tag_indices[self.namespace] = np.array(indices, dtype=np.int32)
 
         if self.num_label is None:
             self.num_label = len(self.index_to_label)
@@ -110,51 +142,59 @@ class TokenLabelVocabulary(object):
             assert (self.num_label == len(self.index_to_label))
 
     def add_indices(self, examples):
+        label_to_index = self.label_to_index
         for example in examples:
-            for tag in example.token_tags[self.namespace]:
-                if tag == -1:
-                    example.token_tag_indices[self.namespace].append(-1)
-                else:
-                    example.token_tag_indices[self.namespace].append(self.label_to_index[tag])
+            example.token_tag_indices[self.namespace] = np.array(
+                [-1 if tag == -1 else label_to_index[tag] for tag in example.token_tags[self.namespace]],
+                dtype=np.int32)
+
+
+def get_head_ids(example, feature, result, max_seq_length):
+    """Map the predicted head token of each word to a 0-origin word id (-1 for ROOT)."""
+    num_lines = len(example.lines)
+    # 1 for [CLS]
+    pred_head_ids = np.asarray(result.heads)[feature.orig_to_tok_index[:num_lines] + 1]
+    # ROOT -> -1, otherwise map the predicted token back to its word
+    # ([CLS] maps to index -1, i.e. the last word, as with list indexing)
+    head_ids = np.full(num_lines, -1, dtype=np.int64)
+    not_root = pred_head_ids != max_seq_length - 1
+    head_ids[not_root] = feature.tok_to_orig_index[pred_head_ids[not_root] - 1]
+    return head_ids.tolist()
 
 
 def get_head_ids_types(example, feature, result, max_seq_length):
-    head_ids = {}
-    dpnd_types = {}
-    for line_num, line in enumerate(example.lines):
-        items = line.split("\t")
-        # 1 for [CLS]
-        pred_head_id = result.heads[feature.orig_to_tok_index[line_num] + 1]
-        # ROOT
-        if pred_head_id == max_seq_length - 1:
-            pred_head_id = -1
-        else:
-            pred_head_id = feature.tok_to_orig_index[pred_head_id - 1]
-        head_ids[line_num] = pred_head_id
-        dpnd_types[line_num] = items[7]
+    head_ids = get_head_ids(example, feature, result, max_seq_length)
+    dpnd_types = [cols[7] for cols in example.line_cols]
     return head_ids, dpnd_types
 
 
 def get_sentence_str(example):
-    return ''.join(line.split('\t')[1] for line in example.lines)
+    return ''.join(cols[1] for cols in example.line_cols)
+
+
+@lru_cache(maxsize=4096)
+def parse_knp_string(knp, sentence):
+    """Parse a sentence with KNP and return the output string, reusing the output for repeated sentences.
+
+    The string is cached rather than the BList because callers modify the parsed result.
+    """
+    return knp.parse(sentence).all()
 
 
 def modify_knp_for_tag_or_bunsetsu(tags, head_ids, dpnd_types, mode):
-    mrph_id2tag = {}
-    for tag in tags:
-        for mrph in tag.mrph_list():
-            mrph_id2tag[mrph.mrph_id] = tag
-
-    for tag in tags:
-        # この基本句内の形態素IDリスト
-        in_tag_mrph_ids = {}
-        last_mrph_id_in_tag = -1
-        for mrph in tag.mrph_list():
-            in_tag_mrph_ids[mrph.mrph_id] = 1
-            if last_mrph_id_in_tag < mrph.mrph_id:
-                last_mrph_id_in_tag = mrph.mrph_id
-
-        for mrph_id in list(in_tag_mrph_ids.keys()):
+    # 基本句ごとの形態素IDリスト (形態素IDは昇順)
+    tag_mrph_ids = [[mrph.mrph_id for mrph in tag.mrph_list()] for tag in tags]
+    mrph_id2tag = [None] * (max((mrph_ids[-1] for mrph_ids in tag_mrph_ids if mrph_ids), default=-1) + 1)
+    for tag, mrph_ids in zip(tags, tag_mrph_ids):
+        for mrph_id in mrph_ids:
+            mrph_id2tag[mrph_id] = tag
+
+    for tag, in_tag_mrph_ids in zip(tags, tag_mrph_ids):
+        if not in_tag_mrph_ids:
+            continue
+        last_mrph_id_in_tag = in_tag_mrph_ids[-1]
+
+        for mrph_id in in_tag_mrph_ids:
             # 形態素係り先ID
             mrph_head_id = head_ids[mrph_id]
             # 形態素係り先がROOTの場合は何もしない
@@ -205,20 +245,15 @@ def read_pos_list(pos_list_file):
             items = line.strip().split('\t')
             POS[items[0]] = items[1]
             REV_POS[items[1]] = items[0]
+            pos, _, spos = items[0].partition('-')
+            POS_KEY[(pos, spos or '*')] = items[1]
 
 
 def get_pos(pos, spos):
-    if spos == '*':
-        key = pos
-    elif pos == '未定義語':
-        key = '未定義語-その他'
-    else:
-        key = '%s-%s' % (pos, spos)
-
-    if key in POS:
-        return POS[key]
-    else:
-        assert 'Unknown POS'
+    if pos == '未定義語' and spos != '*':
+        spos = 'その他'
+    # None for an unknown POS
+    return POS_KEY.get((pos, spos))
 
 
 def jpp2conll_one_sentence(buff):
@@ -237,31 +272,21 @@ def jpp2conll_one_sentence(buff):
         if line.startswith("#"):
             output_lines.append(line)
             continue
-        result = []
         if line.startswith('EOS'):
             break
         items = line.strip().split('\t')
 
         if prev_id == items[1]:
             continue  # skip the same id
-        else:
-            result.append(str(items[1]))
-            prev_id = items[1]
-        result.append(items[5])  # midasi
-        result.append(items[8])  # genkei
+        prev_id = items[1]
         conll_pos = get_pos(items[9], items[11])  # hinsi, bunrui
-        result.append(conll_pos)
-        result.append(conll_pos)
-        result.append('_')
         if len(items) > 19:
-            result.append(items[18])  # head
-            result.append(items[19])  # dpnd_type
+            head, dpnd_type = items[18], items[19]
         else:
-            result.append('0')  # head
-            result.append('D')  # dpnd_type (dummy)
-        result.append('_')
-        result.append('_')
-        output_lines.append('\t'.join(result))
+            head, dpnd_type = '0', 'D'  # dpnd_type (dummy)
+        # id, midasi, genkei
+        output_lines.append('\t'.join((items[1], items[5], items[8], conll_pos, conll_pos, '_', head, dpnd_type,
+                                       '_', '_')))
     return '\n'.join(output_lines) + '\n\n'  # conll format ends with empty line
 
 
@@ -320,24 +345,27 @@ def read_parsing_examples(reader, input_format, is_training, h2z=False, multi_se
         multi_sentences (bool): input string includes multiple sentences or not
     """
     assert input_format in ('lattice', 'knp', 'conll'), 'format: "{}" is not supported'.format(input_format)
-    buff_conll = ''
+    # collect lines and converted sentences in lists and join them once; repeated `str +=` is quadratic
+    buff_conll = []
     buff_knps = []
-    buff = ''
+    buff_lines = []
     for line in reader:
-        buff += line
+        buff_lines.append(line)
         if line.strip() == 'EOS':
+            buff = ''.join(buff_lines)
             if input_format == 'lattice':
-                buff_conll += jpp2conll_one_sentence(buff)
+                buff_conll.append(jpp2conll_one_sentence(buff))
             elif input_format == 'knp':
-                buff_conll += knp2conll_one_sentence(buff)
+                buff_conll.append(knp2conll_one_sentence(buff))
                 buff_knps.append(buff)
             else:
                 assert input_format == 'conll'
-                buff_conll += buff
-            buff = ''
+                buff_conll.append(buff)
+            buff_lines = []
             if multi_sentences is False:
                 break
 
+    buff_conll = ''.join(buff_conll)
     if not buff_conll:
         return []
 
@@ -351,7 +379,7 @@ def read_parsing_examples_from_buf(buff, buff_knps, is_training, h2z=False):
     example_id = 0
 
     # 1       村山    村山    NNP     NNP     _       2       D       _       _
-    words, heads, lines, word_to_char_index = [], [], [], []
+    words, heads, lines, line_cols, word_to_char_index = [], [], [], [], []
     token_tags = defaultdict(list)
     comment = None
     for line in buff.splitlines():
@@ -364,6 +392,7 @@ def read_parsing_examples_from_buf(buff, buff_knps, is_training, h2z=False):
                 example_id,
                 words,
                 lines,
+                line_cols=line_cols,
                 knp_string=buff_knps[example_id] if buff_knps else None,
                 heads=heads,
                 token_tags=token_tags,
@@ -372,7 +401,7 @@ def read_parsing_examples_from_buf(buff, buff_knps, is_training, h2z=False):
             examples.append(example)
 
             example_id += 1
-            words, heads, lines, word_to_char_index = [], [], [], []
+            words, heads, lines, line_cols, word_to_char_index = [], [], [], [], []
             token_tags = defaultdict(list)
             comment = None
             continue
@@ -388,6 +417,7 @@ def read_parsing_examples_from_buf(buff, buff_knps, is_training, h2z=False):
         words.append(word)
         heads.append(head)
         lines.append(line)
+        line_cols.append(tuple(items))
 
     return examples
 
@@ -400,99 +430,78 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, vocab_size
     unique_id = 1000000000
 
     features = []
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    # word -> sub tokens; words repeat a lot across sentences
+    tokenize_cache = {}
 
     for (example_index, example) in enumerate(examples):
         # The -3 accounts for [CLS], [SEP], ROOT
         # max_tokens_for_doc = max_seq_length - 3
 
-        tokens = []
-        segment_ids = []
-        heads = []
+        all_tokens, tok_to_orig_index, orig_to_tok_index = get_tokenized_tokens(example.words, tokenizer,
+                                                                                tokenize_cache)
+        orig_to_tok_index_array = np.array(orig_to_tok_index, dtype=np.int32)
         token_tag_indices = defaultdict(list)
 
-        all_tokens, tok_to_orig_index, orig_to_tok_index = get_tokenized_tokens(example.words, tokenizer)
-
-        # CLS
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        heads.append(-1)
-
-        for j, token in enumerate(all_tokens):
-            tokens.append(token)
-
-            # parsing
-            if is_training is False:
-                head_id = -1
-            else:
-                head = example.heads[tok_to_orig_index[j]]
-                # ROOT
-                if head == 0:
-                    head_id = max_seq_length - 1
-                elif token.startswith("##") is True or head == -1:
-                    head_id = -1
-                else:
-                    head_id = orig_to_tok_index[head - 1] + 1
-            heads.append(head_id)
-
-            segment_ids.append(0)
-
-        # SEP
-        tokens.append("[SEP]")
-        heads.append(-1)
-        segment_ids.append(0)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        # [CLS] + tokens + [SEP], then zero-padding (except for ROOT)
+        tokens = ["[CLS]"] + all_tokens + ["[SEP]"]
+        sep_index = len(tokens) - 1
+        assert len(tokens) <= max_seq_length - num_special_tokens, \
+            "input_ids_length ({}) is greater than max_seq_length ({})".format(
+                len(tokens) + num_special_tokens, max_seq_length)
+
+        # int64 to match torch.long; padding positions keep their initial values
+        input_ids = np.zeros(max_seq_length, dtype=np.int64)
+        input_mask = np.zeros(max_seq_length, dtype=np.int64)
+        segment_ids = np.zeros(max_seq_length, dtype=np.int64)
+        heads = np.full(max_seq_length, -1, dtype=np.int64)
+
+        if is_training is True and all_tokens:
+            # 1-origin head word of each token
+            token_heads = np.asarray(example.heads)[tok_to_orig_index]
+            is_subword = np.array([token.startswith("##") for token in all_tokens])
+            # 1 for [CLS]
+            heads[1:sep_index] = np.where(
+                token_heads == 0,
+                max_seq_length - 1,  # ROOT
+                np.where(is_subword | (token_heads == -1),
+                         -1,
+                         orig_to_tok_index_array[np.clip(token_heads - 1, 0, None)] + 1))
+
+        input_ids[0] = cls_id
+        input_ids[1:sep_index] = tokenizer.convert_tokens_to_ids(all_tokens)
+        input_ids[sep_index] = sep_id
+        # ROOT
+        input_ids[-1] = vocab_size
 
         # The mask has 1 for real tokens and 0 for padding tokens. Only real
         # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length (except for ROOT).
-        while len(input_ids) < max_seq_length - num_special_tokens:
-            input_ids.append(0)
-            input_mask.append(0)
-            heads.append(-1)
-            segment_ids.append(0)
-
-        # ROOT
-        input_ids.append(vocab_size)
-        input_mask.append(1)
-        heads.append(-1)
-        segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length, "input_ids_length ({}) is greater than max_seq_length ({})".format(
-            len(input_ids), max_seq_length)
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-        for namespace in token_tag_indices:
-            assert len(token_tag_indices[namespace]) == max_seq_length
-
-        assert len(heads) == max_seq_length
+        input_mask[:sep_index + 1] = 1
+        input_mask[-1] = 1
 
-        if example_index < 20:
+        if example_index < 20 and logger.isEnabledFor(logging.INFO):
             logger.info("*** Example ***")
             logger.info("unique_id: %s" % unique_id)
             logger.info("example_index: %s" % example_index)
-            logger.info("tokens: %s" % " ".join(
-                [x for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+            logger.info("tokens: %s" % " ".join(tokens))
+            logger.info("input_ids: %s" % " ".join(map(str, input_ids.tolist())))
             logger.info(
-                "input_mask: %s" % " ".join([str(x) for x in input_mask]))
+                "input_mask: %s" % " ".join(map(str, input_mask.tolist())))
             logger.info(
-                "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+                "segment_ids: %s" % " ".join(map(str, segment_ids.tolist())))
             logger.info(
-                "heads: %s" % " ".join([str(x) for x in heads]))
+                "heads: %s" % " ".join(map(str, heads.tolist())))
             for namespace in token_tag_indices:
                 logger.info(
-                    "%s_tags: %s" % (namespace, " ".join([str(x) for x in token_tag_indices[namespace]])))
+                    "%s_tags: %s" % (namespace, " ".join(map(str, token_tag_indices[namespace]))))
 
         features.append(
             InputFeatures(
                 unique_id=unique_id,
                 example_index=example_index,
                 tokens=tokens,
-                orig_to_tok_index=orig_to_tok_index,
-                tok_to_orig_index=tok_to_orig_index,
+                orig_to_tok_index=orig_to_tok_index_array,
+                tok_to_orig_index=np.array(tok_to_orig_index, dtype=np.int32),
                 input_ids=input_ids,
                 input_mask=input_mask,
                 segment_ids=segment_ids,
@@ -503,9 +512,17 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length, vocab_size
     return features
 
 
-RawResult = namedtuple("RawResult",
-                       ["unique_id", "heads", "topk_heads", "topk_dep_labels", "token_tags",
-                        "top_spans"])
+class RawResult(object):
+    """Model output for one feature. One instance is kept per evaluated example, so it uses __slots__."""
+    __slots__ = ("unique_id", "heads", "topk_heads", "topk_dep_labels", "token_tags", "top_spans")
+
+    def __init__(self, unique_id, heads, topk_heads=None, topk_dep_labels=None, token_tags=None, top_spans=None):
+        self.unique_id = unique_id
+        self.heads = heads
+        self.topk_heads = topk_heads
+        self.topk_dep_labels = topk_dep_labels
+        self.token_tags = token_tags
+        self.top_spans = top_spans
 
 
 def write_predictions(all_examples, all_features, all_results, output_prediction_file, max_seq_length, knp_dpnd,
@@ -515,12 +532,13 @@ def write_predictions(all_examples, all_features, all_results, output_prediction
         logger.info("Writing predictions to: {}".format(output_prediction_file))
 
     if knp_mode:
+        outputs = []
         for example, feature, result in zip(all_examples, all_features, all_results):
             if example.knp_string is not None:
                 # reuse input knp string as much as possible
                 knp_result = knp_dpnd.reparse_knp_result(example.knp_string.strip())
             else:
-                knp_result = knp_dpnd.parse(get_sentence_str(example))
+                knp_result = knp_dpnd.result(parse_knp_string(knp_dpnd, get_sentence_str(example)))
             knp_result.comment = example.comment
             head_ids, dpnd_types = get_head_ids_types(example, feature, result, max_seq_length)
             modify_knp(knp_result, head_ids, dpnd_types)
@@ -528,28 +546,128 @@ def write_predictions(all_examples, all_features, all_results, output_prediction
             # add predicate-argument structures by KNP
             knp_result_new = knp_case.reparse_knp_result(knp_result.all().strip())
             if output_tree:
-                sys.stdout.write(sprint_tag_tree(knp_result_new))
+                outputs.append(sprint_tag_tree(knp_result_new))
             else:
-                sys.stdout.write(knp_result_new.all())
+                outputs.append(knp_result_new.all())
+        sys.stdout.write("".join(outputs))
+        sys.stdout.flush()
     else:
-        with open(output_prediction_file, "w", encoding="utf-8") as writer:
+        if output_prediction_file is None:
+            writer = sys.stdout
+        else:
+            writer = open(output_prediction_file, "w", encoding="utf-8", buffering=1 << 20)
+        try:
             for example, feature, result in zip(all_examples, all_features, all_results):
+                # one write per example
+                outputs = []
                 if example.comment is not None:
-                    writer.write("{}\n".format(example.comment))
-
-                for line_num, line in enumerate(example.lines):
-                    items = line.split("\t")
-                    # 1 for [CLS]
-                    pred_head_id = result.heads[feature.orig_to_tok_index[line_num] + 1]
-                    # ROOT
-                    if pred_head_id == max_seq_length - 1:
-                        pred_head_id = 0
-                    else:
-                        pred_head_id = feature.tok_to_orig_index[pred_head_id - 1] + 1
+                    outputs.append("{}\n".format(example.comment))
+
+                head_ids = get_head_ids(example, feature, result, max_seq_length)
+                for cols, head_id in zip(example.line_cols, head_ids):
+                    items = list(cols)
+                    # 1-origin, 0 for ROOT
+                    items[6] = str(head_id + 1)
+                    outputs.append("\t".join(items) + "\n")
+                outputs.append("\n")
+                writer.write("".join(outputs))
+        finally:
+            if writer is sys.stdout:
+                writer.flush()
+            else:
+                writer.close()
+
 
-                    items[6] = str(pred_head_id)
-                    writer.write("\t".join(items) + "\n")
-                writer.write("\n")
+class LengthBucketBatchSampler(object):
+    """Yield shuffled batches of examples whose lengths fall into the same bucket.
+
+    Examples are shuffled, stably sorted by `length // bucket_width` and cut into batches, and then the order of
+    the batches is shuffled, so that each batch needs little padding. With `num_replicas` > 1 every replica takes
+    every `num_replicas`-th batch (wrapping around so that all replicas get the same number of batches); call
+    `set_epoch` at the beginning of each epoch to reshuffle consistently across replicas.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_width, num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_width = bucket_width
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_batches = -(-len(self.lengths) // batch_size)
+        self.num_batches_per_replica = -(-self.num_batches // num_replicas)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches_per_replica
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths))
+        indices = indices[np.argsort(self.lengths[indices] // self.bucket_width, kind="stable")]
+        batches = [indices[i:i + self.batch_size].tolist() for i in range(0, len(indices), self.batch_size)]
+        order = rng.permutation(len(batches)).tolist()
+        # repeat the order cyclically, as DistributedSampler does, in case there are fewer batches than replicas
+        total_size = self.num_batches_per_replica * self.num_replicas
+        order = (order * -(-total_size // len(order)))[:total_size]
+        for batch_index in order[self.rank::self.num_replicas]:
+            yield batches[batch_index]
+
+
+def collate_trimmed_batch(batch, pad_to_multiple_of=1):
+    """Stack training features and drop the padding columns that no example in the batch uses.
+
+    ROOT stays in the last column, keeps its position id (max_seq_length - 1) and heads on ROOT are re-indexed.
+    The number of columns is rounded up to a multiple of `pad_to_multiple_of` (at most max_seq_length).
+    """
+    # inputs: [batch_size, 3 (input_ids, input_mask, segment_ids), max_seq_length]
+    inputs, heads = (torch.stack(tensors) for tensors in zip(*batch))
+    max_seq_length = inputs.size(2)
+    # [CLS] tokens [SEP] of the longest example, plus padding so that the width with ROOT is a round number
+    length = int(inputs[:, 1, :-1].sum(dim=1).max())
+    length = min(-(-(length + 1) // pad_to_multiple_of) * pad_to_multiple_of, max_seq_length) - 1
+    position_ids = torch.cat([torch.arange(length, dtype=torch.long),
+                              torch.tensor([max_seq_length - 1], dtype=torch.long)])
+    heads = heads[:, position_ids]
+    heads[heads == max_seq_length - 1] = length
+    # not an expanded view: pinning the batch copies into a tensor with the same strides
+    return inputs[:, :, position_ids], heads, position_ids.unsqueeze(0).expand(inputs.size(0), -1).contiguous()
+
+
+class CUDAPrefetcher(object):
+    """Wrap a DataLoader and copy the next batch to the GPU on a side stream while the current batch is used."""
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # the tensors were allocated on the side stream; keep them alive until the compute stream is done
+            for t in batch:
+                t.record_stream(current_stream)
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return tuple(t.to(self.device, non_blocking=True) for t in batch)
 
 
 class Word(object):
@@ -560,47 +678,59 @@ class Word(object):
         self.parent_word_index = None
 
 
-def has_cycle(head_char_id, char_to_word_index, words, target_word_index):
-    head_word_index = char_to_word_index[head_char_id - 1]
-    while True:
-        if words[head_word_index].parent_word_index is None:
-            return False
+def contains_nan(tensors):
+    """Return True if any of the tensors contains NaN, with a single device-to-host sync."""
+    if hasattr(torch, "_foreach_norm"):
+        # NaN propagates to the norm; one fused kernel for all the tensors
+        norms = torch._foreach_norm(tensors)
+    else:
+        norms = [tensor.norm() for tensor in tensors]
+    return bool(torch.isnan(torch.stack(norms)).any())
 
-        # cycle
-        if words[head_word_index].parent_word_index == target_word_index:
-            return True
 
-        head_word_index = words[head_word_index].parent_word_index
+def copy_tensors_(dst_tensors, src_tensors):
+    """Copy each source tensor into the corresponding destination tensor, in one fused call if available."""
+    if hasattr(torch, "_foreach_copy_"):
+        torch._foreach_copy_(dst_tensors, src_tensors)
+    else:
+        for dst, src in zip(dst_tensors, src_tensors):
+            dst.copy_(src)
 
 
 def copy_optimizer_params_to_model(named_params_model, named_params_optimizer):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the parameters optimized on CPU/RAM back to the model on GPU
     """
+    params_model, params_opti = [], []
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
         if name_opti != name_model:
             logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
             raise ValueError
-        param_model.data.copy_(param_opti.data)
+        params_model.append(param_model.data)
+        params_opti.append(param_opti.data)
+    copy_tensors_(params_model, params_opti)
 
 
 def set_optimizer_params_grad(named_params_optimizer, named_params_model, test_nan=False):
-    """ Utility function for optimize_on_cpu and 16-bits training.
+    """ Utility function for optimize_on_cpu training.
         Copy the gradient of the GPU parameters to the CPU/RAMM copy of the model
     """
     is_nan = False
+    grads_opti, grads_model = [], []
     for (name_opti, param_opti), (name_model, param_model) in zip(named_params_optimizer, named_params_model):
         if name_opti != name_model:
             logger.error("name_opti != name_model: {} {}".format(name_opti, name_model))
             raise ValueError
         if param_model.grad is not None:
-            if test_nan and torch.isnan(param_model.grad).sum() > 0:
-                is_nan = True
             if param_opti.grad is None:
                 param_opti.grad = torch.nn.Parameter(param_opti.data.new().resize_(*param_opti.data.size()))
-            param_opti.grad.data.copy_(param_model.grad.data)
+            grads_opti.append(param_opti.grad.data)
+            grads_model.append(param_model.grad.data)
         else:
             param_opti.grad = None
+    if test_nan and grads_model:
+        is_nan = contains_nan(grads_model)
+    copy_tensors_(grads_opti, grads_model)
     return is_nan
 
 
@@ -665,10 +795,24 @@ def main():
     parser.add_argument('--fp16',
                         default=False,
                         action='store_true',
-                        help="Whether to use 16-bit float precision instead of 32-bit")
+                        help="Whether to use 16-bit float precision (automatic mixed precision) instead of 32-bit")
     parser.add_argument('--loss_scale',
                         type=float, default=128,
-                        help='Loss scaling, positive power of 2 values can improve fp16 convergence.')
+                        help='Initial loss scaling for fp16 training (adjusted dynamically), '
+                             'positive power of 2 values can improve fp16 convergence.')
+    parser.add_argument("--num_workers", default=0, type=int,
+                        help="Number of worker processes for loading batches (0: load in the main process).")
+    parser.add_argument("--prefetch_factor", default=2, type=int,
+                        help="Number of batches loaded in advance by each worker.")
+    parser.add_argument("--length_bucket_width", default=0, type=int,
+                        help="Batch training examples of similar length (in buckets of this many tokens) and trim "
+                             "the padding unused in each batch, which also drops it from the head candidates "
+                             "(e.g. 16; 0: random batches padded to max_seq_length).")
+    parser.add_argument("--pad_to_multiple_of", default=8, type=int,
+                        help="Round the trimmed sequence length of --length_bucket_width batches up to a multiple "
+                             "of this (8 keeps the matmul sizes tensor core friendly; 1: no rounding).")
+    parser.add_argument("--overwrite_features_cache", default=False, action='store_true',
+                        help="Convert the training examples again instead of loading the cached features.")
     parser.add_argument("--special_tokens", default=None, type=str,
                         help="Special tokens.")
     parser.add_argument("--finetuning_added_tokens", default=None, type=str,
@@ -692,6 +836,14 @@ def main():
                         help="Specify a pos.list file to convert a Juman++ file to CoNLL.")
     parser.add_argument("--single_sentence", default=False, action='store_true',
                         help="If you use bertknp from pyknp, you should specify this flag.")
+    parser.add_argument("--use_ipex", default=False, action='store_true',
+                        help="Optimize the model for CPU prediction with Intel Extension for PyTorch.")
+    parser.add_argument("--bf16", default=False, action='store_true',
+                        help="Use bfloat16 for CPU prediction with --use_ipex.")
+    parser.add_argument("--tf32", default=False, action='store_true',
+                        help="Allow TF32 tensor cores for float32 matrix multiplications on CUDA (Ampere or later).")
+    parser.add_argument("--compile", default=False, action='store_true',
+                        help="Compile the model with torch.compile (PyTorch >= 2.2).")
 
     args = parser.parse_args()
 
@@ -705,20 +857,34 @@ def main():
         knp_dpnd = None
         knp_case = None
 
+    if args.do_train and not args.no_cuda and args.local_rank == -1 and "LOCAL_RANK" in os.environ:
+        # training launched with torchrun
+        args.local_rank = int(os.environ["LOCAL_RANK"])
     if args.local_rank == -1 or args.no_cuda:
         device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
         n_gpu = torch.cuda.device_count()
     else:
         device = torch.device("cuda", args.local_rank)
         n_gpu = 1
+        torch.cuda.set_device(device)
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-        if args.fp16:
-            logger.info("16-bits training currently not supported in distributed training")
-            args.fp16 = False  # (see https://github.com/pytorch/pytorch/pull/13496)
     logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits trainiing: {}".format(
         device, n_gpu, bool(args.local_rank != -1), args.fp16))
 
+    if args.tf32 and device.type == "cuda":
+        # TF32 tensor cores for fp32 matmuls (Ampere or later)
+        torch.backends.cuda.matmul.allow_tf32 = True
+
+    if args.fp16 and device.type != "cuda":
+        raise ValueError("`fp16` training requires a CUDA device.")
+    if args.compile and not hasattr(torch.nn.Module, "compile"):
+        raise ValueError("`compile` requires PyTorch 2.2 or later.")
+    if args.use_ipex and device.type != "cpu":
+        raise ValueError("`use_ipex` is only supported for prediction on CPU (use --no_cuda).")
+    if args.bf16 and not args.use_ipex:
+        raise ValueError("`bf16` requires `use_ipex` (CPU prediction with Intel Extension for PyTorch).")
+
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
             args.gradient_accumulation_steps))
@@ -727,9 +893,8 @@ def main():
 
     random.seed(args.seed)
     np.random.seed(args.seed)
+    # also seeds all CUDA devices (lazily, without creating a CUDA context here)
     torch.manual_seed(args.seed)
-    if n_gpu > 0:
-        torch.cuda.manual_seed_all(args.seed)
 
     if not args.do_train and not args.do_predict:
         raise ValueError("At least one of `do_train` or `do_predict` must be True.")
@@ -788,29 +953,34 @@ def main():
 
         vocab_size = model.config.vocab_size + num_finetuning_added_tokens
 
-        if args.fp16:
-            model.half()
         model.to(device)
+        if args.compile:
+            # compiled in place, so parameter names and the saved state dict are unchanged;
+            # CUDA graphs only pay off when every batch has the same shape
+            model.compile(mode="reduce-overhead" if args.length_bucket_width == 0 else "default")
         if args.local_rank != -1:
+            # the pooler of BertModel is not used for the loss
             model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                              output_device=args.local_rank)
+                                                              output_device=args.local_rank,
+                                                              find_unused_parameters=True)
         elif n_gpu > 1:
             model = torch.nn.DataParallel(model)
 
         # Prepare optimizer
-        if args.fp16:
-            param_optimizer = [(n, param.clone().detach().to('cpu').float().requires_grad_())
-                               for n, param in model.named_parameters()]
-        elif args.optimize_on_cpu:
+        # walked once here instead of on every update
+        named_params_model = list(model.named_parameters())
+        if args.optimize_on_cpu and not args.fp16:
             param_optimizer = [(n, param.clone().detach().to('cpu').requires_grad_())
-                               for n, param in model.named_parameters()]
+                               for n, param in named_params_model]
         else:
-            param_optimizer = list(model.named_parameters())
-        no_decay = ['bias', 'gamma', 'beta']
+            param_optimizer = named_params_model
+        no_decay = re.compile('bias|gamma|beta')
+        decay_params, no_decay_params = [], []
+        for n, p in param_optimizer:
+            (no_decay_params if no_decay.search(n) else decay_params).append(p)
         optimizer_grouped_parameters = [
-            {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)],
-             'weight_decay_rate': 0.01},
-            {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay_rate': 0.0}
+            {'params': decay_params, 'weight_decay_rate': 0.01},
+            {'params': no_decay_params, 'weight_decay_rate': 0.0}
         ]
         t_total = num_train_steps
         if args.local_rank != -1:
@@ -819,54 +989,113 @@ def main():
                              lr=args.learning_rate,
                              warmup=args.warmup_proportion,
                              t_total=t_total)
+        # fp32 master weights stay on the GPU; the forward runs under autocast with dynamic loss scaling
+        scaler = torch.amp.GradScaler("cuda", init_scale=args.loss_scale) if args.fp16 else None
 
         global_step = 0
-        train_features = convert_examples_to_features(
-            examples=train_examples,
-            tokenizer=tokenizer,
-            max_seq_length=args.max_seq_length,
-            vocab_size=vocab_size,
-            is_training=True,
-            num_special_tokens=num_special_tokens)
+        cached_features_file = get_cached_features_file(args, tokenizer, vocab_size, num_special_tokens)
+        if args.local_rank not in (-1, 0):
+            # the first process builds the cache and the others read it once it has been written
+            torch.distributed.barrier()
+        if os.path.exists(cached_features_file) and (not args.overwrite_features_cache or
+                                                     args.local_rank not in (-1, 0)):
+            logger.info("Loading features from cached file %s", cached_features_file)
+            with np.load(cached_features_file) as cached_features:
+                train_arrays = {name: cached_features[name] for name in cached_features.files}
+        else:
+            train_features = convert_examples_to_features(
+                examples=train_examples,
+                tokenizer=tokenizer,
+                max_seq_length=args.max_seq_length,
+                vocab_size=vocab_size,
+                is_training=True,
+                num_special_tokens=num_special_tokens)
+            train_arrays = {name: np.stack([getattr(f, name) for f in train_features])
+                            for name in ("input_ids", "input_mask", "segment_ids", "heads")}
+            if args.local_rank in (-1, 0):
+                logger.info("Saving features into cached file %s", cached_features_file)
+                # write to a temporary file first so that a partially written cache is never loaded
+                tmp_features_file = "{}.{}.tmp".format(cached_features_file, os.getpid())
+                with open(tmp_features_file, "wb") as writer:
+                    np.savez(writer, **train_arrays)
+                os.replace(tmp_features_file, cached_features_file)
+        if args.local_rank == 0:
+            torch.distributed.barrier()
         logger.info("***** Running training *****")
         logger.info("  Num orig examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
+        # input_ids, input_mask and segment_ids are always used together: one [N, 3, max_seq_length] tensor
+        all_inputs = torch.from_numpy(np.stack([train_arrays["input_ids"], train_arrays["input_mask"],
+                                                train_arrays["segment_ids"]], axis=1))
 
         # pos tagging, parsing
-        all_heads = torch.tensor([f.heads for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_heads)
-
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+        all_heads = torch.from_numpy(train_arrays["heads"])
+        train_data = TensorDataset(all_inputs, all_heads)
+
+        dataloader_kwargs = {}
+        if args.length_bucket_width > 0:
+            num_replicas, rank = 1, 0
+            if args.local_rank != -1:
+                num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+            train_sampler = LengthBucketBatchSampler(train_arrays["input_mask"].sum(axis=1), args.train_batch_size,
+                                                     args.length_bucket_width, num_replicas=num_replicas, rank=rank,
+                                                     seed=args.seed)
+            dataloader_kwargs.update(batch_sampler=train_sampler,
+                                     collate_fn=partial(collate_trimmed_batch,
+                                                        pad_to_multiple_of=args.pad_to_multiple_of))
         else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            dataloader_kwargs.update(sampler=train_sampler, batch_size=args.train_batch_size)
+        # overlap the host-to-device copy of the next batch with the current step
+        pin_memory = device.type == "cuda"
+        prefetch = pin_memory and n_gpu == 1
+        if args.num_workers > 0:
+            # keep workers alive across epochs
+            dataloader_kwargs.update(num_workers=args.num_workers, prefetch_factor=args.prefetch_factor,
+                                     persistent_workers=True)
+        train_dataloader = DataLoader(train_data, pin_memory=pin_memory, **dataloader_kwargs)
+        if prefetch:
+            train_dataloader = CUDAPrefetcher(train_dataloader, device)
 
         model.train()
-        for i in trange(int(args.num_train_epochs), desc="Epoch"):
-            tr_loss = 0
+        # refresh the progress bars at most every few seconds, and only on the main process
+        disable_progress_bar = args.local_rank not in (-1, 0)
+        for i in trange(int(args.num_train_epochs), desc="Epoch", disable=disable_progress_bar):
+            # accumulated on the device; read back once per epoch instead of syncing on every step
+            tr_loss = torch.zeros((), dtype=torch.float64, device=device)
             nb_tr_steps = 0
-            for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
-                if n_gpu == 1:
-                    batch = tuple(t.to(device) for t in batch)  # multi-gpu does scattering it-self
+            if hasattr(train_sampler, "set_epoch"):
+                train_sampler.set_epoch(i)
+            for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration", mininterval=5.0,
+                                              disable=disable_progress_bar)):
+                if n_gpu == 1 and not prefetch:
+                    batch = tuple(t.to(device, non_blocking=True) for t in batch)
 
                 token_tags = None
-                input_ids, input_mask, segment_ids, heads = batch
-                loss = model(input_ids, segment_ids, input_mask, heads=heads, token_tags=token_tags)
-                tr_loss, nb_tr_steps, global_step = update_parameters(args, loss, n_gpu, tr_loss, step, nb_tr_steps,
-                                                                      model, optimizer, global_step, param_optimizer)
-
-            print("loss {}: {:.3f}".format(i, tr_loss / nb_tr_steps), file=sys.stderr)
+                inputs, heads, *rests = batch
+                input_ids, input_mask, segment_ids = inputs.unbind(dim=1)
+                position_ids = rests[0] if rests else None
+                sync = (step + 1) % args.gradient_accumulation_steps == 0
+                with gradient_sync_context(model, sync):
+                    with autocast_context(args.fp16):
+                        loss = model(input_ids, segment_ids, input_mask, heads=heads, token_tags=token_tags,
+                                     position_ids=position_ids)
+                    tr_loss, nb_tr_steps, global_step = update_parameters(args, loss, n_gpu, tr_loss, step,
+                                                                          nb_tr_steps, model, optimizer, global_step,
+                                                                          param_optimizer, named_params_model, scaler)
+
+            print("loss {}: {:.3f}".format(i, tr_loss.item() / nb_tr_steps), file=sys.stderr)
 
         # Save a trained model
         model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
         torch.save(model_to_save.state_dict(), output_model_file)
 
-    if args.do_predict:
+    # predictions are made and written by a single process
+    if args.do_predict and args.local_rank in (-1, 0):
         # Load a trained model that you have fine-tuned
         model_state_dict = torch.load(output_model_file,
                                       map_location='cpu' if n_gpu == 0 or args.no_cuda is True else None)
@@ -881,11 +1110,15 @@ def main():
         if vocab_size is None:
             vocab_size = model.config.vocab_size + num_finetuning_added_tokens
         model.to(device)
-        if args.local_rank != -1:
-            model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                              output_device=args.local_rank)
-        elif n_gpu > 1:
+        if n_gpu > 1:
             model = torch.nn.DataParallel(model)
+        if args.use_ipex:
+            import intel_extension_for_pytorch as ipex
+            model.eval()
+            model = ipex.optimize(model, dtype=torch.bfloat16 if args.bf16 else torch.float32)
+        if args.compile:
+            # inputs are always padded to max_seq_length
+            model.compile(mode="reduce-overhead")
 
         # read examples
         while True:
@@ -914,48 +1147,42 @@ def main():
             logger.info("  Num orig examples = %d", len(eval_examples))
             logger.info("  Batch size = %d", args.predict_batch_size)
 
-            all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-            all_example_index = torch.arange(all_input_ids.size()[0], dtype=torch.long)
-            eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
-            if args.local_rank == -1:
-                eval_sampler = SequentialSampler(eval_data)
-            else:
-                eval_sampler = DistributedSampler(eval_data)
-            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size)
+            all_inputs = torch.from_numpy(np.stack([(f.input_ids, f.input_mask, f.segment_ids)
+                                                    for f in eval_features]))
+            eval_data = TensorDataset(all_inputs)
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader_kwargs = {}
+            if args.num_workers > 0 and args.knp_mode is False:
+                # not for the knp mode, where a loader is built for every input and workers would be started each time
+                eval_dataloader_kwargs = dict(num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size,
+                                         pin_memory=device.type == "cuda", **eval_dataloader_kwargs)
 
             model.eval()
-            all_results = []
             logger.info("Start evaluating")
-            for input_ids, input_mask, segment_ids, example_indices, *rests in tqdm(eval_dataloader, desc="Evaluating"):
-                if len(all_results) % 1000 == 0:
-                    logger.info("Processing example: %d" % (len(all_results)))
-                input_ids = input_ids.to(device)
-                input_mask = input_mask.to(device)
-                segment_ids = segment_ids.to(device)
+            # the loader yields the examples in the order of the sampler, so the example indices stay on the host
+            sampled_example_indices = list(eval_sampler)
+            all_results = [None] * len(sampled_example_indices)
+            num_results = 0
+            for inputs, *rests in tqdm(eval_dataloader, desc="Evaluating", mininterval=5.0):
+                if num_results % 1000 == 0:
+                    logger.info("Processing example: %d" % num_results)
+                input_ids, input_mask, segment_ids = inputs.to(device, non_blocking=True).unbind(dim=1)
 
                 with torch.no_grad():
-                    ret_dict = model(input_ids, segment_ids, input_mask)
-                for i, example_index in enumerate(example_indices):
-                    heads, token_tags, topk_heads, topk_dep_labels = None, None, None, None
-                    top_spans = None
-                    heads = ret_dict["heads"][i].detach().cpu().tolist()
-                    topk_heads = ret_dict["topk_heads"][i].detach().cpu().tolist()
-                    if args.estimate_dep_label is True:
-                        topk_dep_labels = ret_dict["topk_dep_labels"][i].detach().cpu().tolist()
-
-                    eval_feature = eval_features[example_index.item()]
-                    unique_id = int(eval_feature.unique_id)
-
-                    all_results.append(
-                        RawResult(unique_id=unique_id,
-                                  heads=heads,
-                                  topk_heads=topk_heads,
-                                  topk_dep_labels=topk_dep_labels,
-                                  token_tags=token_tags,
-                                  top_spans=top_spans)
-                    )
+                    if args.use_ipex and args.bf16:
+                        with torch.autocast("cpu", dtype=torch.bfloat16):
+                            ret_dict = model(input_ids, segment_ids, input_mask)
+                    else:
+                        ret_dict = model(input_ids, segment_ids, input_mask)
+                # one device-to-host copy for the whole batch instead of one per example; write_predictions
+                # only reads the heads, so topk_heads and topk_dep_labels are not copied back
+                batch_heads = ret_dict["heads"].detach().cpu().tolist()
+                example_indices = sampled_example_indices[num_results:num_results + inputs.size(0)]
+                for heads, example_index in zip(batch_heads, example_indices):
+                    eval_feature = eval_features[example_index]
+                    all_results[num_results] = RawResult(unique_id=int(eval_feature.unique_id), heads=heads)
+                    num_results += 1
 
             if args.prediction_result_filename == "-":
                 # stdout
@@ -968,7 +1195,6 @@ def main():
                               knp_mode=args.knp_mode, output_tree=args.output_tree)
             if args.knp_mode is False:
                 break
-            sys.stdout.flush()
 
 
 def preprocess_vocab(tokenizer, args):
@@ -996,42 +1222,72 @@ def preprocess_vocab(tokenizer, args):
 
 
 def add_vocab(finetuning_added_tokens, tokenizer, model):
-    for i, finetuning_added_token in enumerate(finetuning_added_tokens):
-        tokenizer.vocab[finetuning_added_token] = model.config.vocab_size + i
-        logger.info("added vocab: {} ({})".format(finetuning_added_token, tokenizer.vocab[finetuning_added_token]))
+    added_vocab = {finetuning_added_token: model.config.vocab_size + i
+                   for i, finetuning_added_token in enumerate(finetuning_added_tokens)}
+    tokenizer.vocab.update(added_vocab)
+    logger.info("added vocab: {}".format(", ".join("{} ({})".format(token, index)
+                                                   for token, index in added_vocab.items())))
+
+
+def get_cached_features_file(args, tokenizer, vocab_size, num_special_tokens):
+    """Return the path of the cached training features for the current training file and settings."""
+    train_file_stat = os.stat(args.train_file)
+    key = hashlib.sha1()
+    for value in (os.path.abspath(args.train_file), train_file_stat.st_size, train_file_stat.st_mtime,
+                  args.input_format, args.h2z, args.single_sentence, args.use_training_data_ratio,
+                  args.max_seq_length, args.lang, vocab_size, num_special_tokens):
+        key.update("{}\t".format(value).encode("utf-8"))
+    # the tokenizer is identified by its vocabulary
+    key.update("\n".join("{}\t{}".format(token, index) for token, index in tokenizer.vocab.items()).encode("utf-8"))
+    return os.path.join(args.output_dir, "cached_train_features_{}.npz".format(key.hexdigest()))
+
+
+def gradient_sync_context(model, sync):
+    """Skip the DDP gradient all-reduce on accumulation micro-steps that do not update the parameters."""
+    if not sync and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return model.no_sync()
+    # no-op context manager (contextlib.nullcontext needs python 3.7)
+    return contextlib.ExitStack()
+
+
+def autocast_context(enabled):
+    """Run the forward in mixed precision for fp16 training."""
+    if enabled:
+        return torch.autocast("cuda", dtype=torch.float16)
+    return contextlib.ExitStack()
 
 
 def update_parameters(args, loss, n_gpu, tr_loss, step, nb_tr_steps, model, optimizer, global_step,
-                      param_optimizer):
+                      param_optimizer, named_params_model, scaler=None):
     if n_gpu > 1:
         loss = loss.mean()  # mean() to average on multi-gpu.
-    if args.fp16 and args.loss_scale != 1.0:
-        # rescale loss for fp16 training
-        # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
-        loss = loss * args.loss_scale
     if args.gradient_accumulation_steps > 1:
         loss = loss / args.gradient_accumulation_steps
-    loss.backward()
-    tr_loss += loss.item()
+    if scaler is not None:
+        # rescale loss for fp16 training
+        # see https://docs.nvidia.com/deeplearning/sdk/mixed-precision-training/index.html
+        scaler.scale(loss).backward()
+    else:
+        loss.backward()
+    tr_loss += loss.detach()
     nb_tr_steps += 1
     if (step + 1) % args.gradient_accumulation_steps == 0:
-        if args.fp16 or args.optimize_on_cpu:
-            if args.fp16 and args.loss_scale != 1.0:
-                # scale down gradients for fp16 training
-                for param in model.parameters():
-                    if param.grad is not None:
-                        param.grad.data = param.grad.data / args.loss_scale
-            is_nan = set_optimizer_params_grad(param_optimizer, model.named_parameters(), test_nan=True)
+        if scaler is not None:
+            # unscales the gradients and skips the step (reducing the loss scale) if they contain inf/NaN
+            scaler.step(optimizer)
+            scaler.update()
+        elif args.optimize_on_cpu:
+            is_nan = set_optimizer_params_grad(param_optimizer, named_params_model, test_nan=True)
             if is_nan:
-                logger.info("FP16 TRAINING: Nan in gradients, reducing loss scaling")
-                args.loss_scale = args.loss_scale / 2
-                model.zero_grad()
+                logger.info("Nan in gradients, skipping the update")
+                model.zero_grad(set_to_none=True)
                 return tr_loss, nb_tr_steps, global_step
             optimizer.step()
-            copy_optimizer_params_to_model(model.named_parameters(), param_optimizer)
+            copy_optimizer_params_to_model(named_params_model, param_optimizer)
         else:
             optimizer.step()
-        model.zero_grad()
+        # drop the gradients instead of filling them with zeros; the next backward allocates them again
+        model.zero_grad(set_to_none=True)
         global_step += 1
 
     return tr_loss, nb_tr_steps, global_step
@@ -1039,7 +1295,8 @@ def update_parameters(args, loss, n_gpu, tr_loss, step, nb_tr_steps, model, opti
 
 if __name__ == "__main__":
     sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    # predictions are flushed explicitly after each write_predictions call, so stdout is block buffered
+    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', line_buffering=False, write_through=False)
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
@@ -186,10 +186,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -219,6 +220,8 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # fused kernel (flash / memory-efficient attention) if available
+        self.use_fused_attention = hasattr(nn.functional, "scaled_dot_product_attention")
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
@@ -234,6 +237,15 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if self.use_fused_attention:
+            # computes the same as below
+            context_layer = nn.functional.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask.to(query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+            return context_layer.view(*new_context_layer_shape)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
@@ -580,13 +592,13 @@ class PreTrainedBertModel(nn.Module):
     def expand_vocab(self, num_expand_vocab):
         """Add special tokens to vocab."""
         
-        old_word_embeddings_numpy = self.embeddings.word_embeddings.weight.detach().numpy()
-        vocab_size = self.embeddings.word_embeddings.weight.shape[0]
-        new_word_embeddings = nn.Embedding(vocab_size + num_expand_vocab,
-                                           self.embeddings.word_embeddings.weight.shape[1])
-        new_word_embeddings_numpy = new_word_embeddings.weight.detach().numpy()
-        new_word_embeddings_numpy[:vocab_size, :] = old_word_embeddings_numpy
-        new_word_embeddings.from_pretrained(torch.Tensor(new_word_embeddings_numpy), freeze=False)
+        old_word_embeddings = self.embeddings.word_embeddings.weight
+        vocab_size = old_word_embeddings.shape[0]
+        # allocated once at the final size; the added rows keep the default nn.Embedding initialization
+        new_word_embeddings = nn.Embedding(vocab_size + num_expand_vocab, old_word_embeddings.shape[1]).to(
+            device=old_word_embeddings.device, dtype=old_word_embeddings.dtype)
+        with torch.no_grad():
+            new_word_embeddings.weight[:vocab_size].copy_(old_word_embeddings)
         self.embeddings.word_embeddings = new_word_embeddings
         
         
@@ -608,6 +620,8 @@ class BertModel(PreTrainedBertModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] with the position
+            indices of the tokens. Default: `0, 1, ..., sequence_length - 1`.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -641,7 +655,8 @@ class BertModel(PreTrainedBertModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                position_ids=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -662,7 +677,7 @@ class BertModel(PreTrainedBertModel):
         # extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers)
@@ -1178,6 +1193,8 @@ class BertForParsing(PreTrainedBertModel):
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] with the position
+            indices of the tokens. Default: `0, 1, ..., sequence_length - 1`.
 
     Outputs:
         if `heads` is not `None`:
@@ -1245,8 +1262,9 @@ class BertForParsing(PreTrainedBertModel):
                 
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids, attention_mask, heads=None, token_tags=None):
-        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+    def forward(self, input_ids, token_type_ids, attention_mask, heads=None, token_tags=None, position_ids=None):
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                       position_ids=position_ids)
 
         if self.parsing_algorithm == "biaffine":
             h_i = torch.relu(self.child_arc_linear(sequence_output))
@@ -1271,10 +1289,8 @@ class BertForParsing(PreTrainedBertModel):
 
         g_logits += extended_attention_mask
 
-        # not to modify self
-        seq_length = input_ids.size(1)
-        eye_mask = torch.eye(seq_length, device=input_ids.device).to(dtype=input_ids.dtype) * -10000.0
-        g_logits += eye_mask.unsqueeze(0)
+        # not to modify self (in place on the diagonal instead of materializing an eye mask)
+        g_logits.diagonal(dim1=1, dim2=2).sub_(10000.0)
 
         token_tags_logits = {}
         if self.token_label_vocabulary is not None:
@@ -244,6 +244,44 @@ class BertModelTest(unittest.TestCase):
         self.assertEqual(obj["vocab_size"], 99)
         self.assertEqual(obj["hidden_size"], 37)
 
+    @unittest.skipUnless(hasattr(torch.nn.functional, "scaled_dot_product_attention"),
+                         "scaled_dot_product_attention is not available")
+    def test_fused_attention_matches_manual_attention(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertModel(config=config)
+        model.eval()
+        with torch.no_grad():
+            fused_output, _ = model(input_ids, token_type_ids, input_mask, output_all_encoded_layers=False)
+            for layer in model.encoder.layer:
+                layer.attention.self.use_fused_attention = False
+            manual_output, _ = model(input_ids, token_type_ids, input_mask, output_all_encoded_layers=False)
+        self.assertTrue(torch.allclose(fused_output, manual_output, atol=1e-5))
+
+    def test_default_position_ids(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertModel(config=config)
+        model.eval()
+        position_ids = torch.arange(tester.seq_length, dtype=torch.long).unsqueeze(0).expand_as(input_ids)
+        with torch.no_grad():
+            default_output, _ = model(input_ids, token_type_ids, input_mask, output_all_encoded_layers=False)
+            explicit_output, _ = model(input_ids, token_type_ids, input_mask, output_all_encoded_layers=False,
+                                       position_ids=position_ids)
+        self.assertTrue(torch.equal(default_output, explicit_output))
+
+    def test_expand_vocab(self):
+        tester = BertModelTest.BertModelTester(self)
+        config = tester.prepare_config_and_inputs()[0]
+        model = BertModel(config=config)
+        old_weight = model.embeddings.word_embeddings.weight.detach().clone()
+        model.expand_vocab(num_expand_vocab=3)
+        new_weight = model.embeddings.word_embeddings.weight
+        self.assertListEqual(list(new_weight.size()), [tester.vocab_size + 3, tester.hidden_size])
+        self.assertEqual(new_weight.dtype, old_weight.dtype)
+        self.assertTrue(new_weight.requires_grad)
+        self.assertTrue(torch.equal(new_weight[:tester.vocab_size].detach(), old_weight))
+
     def run_tester(self, tester):
         config_and_inputs = tester.prepare_config_and_inputs()
         output_result = tester.create_bert_model(*config_and_inputs)
@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples"))
+from run_parsing import LengthBucketBatchSampler, collate_trimmed_batch
+
+
+class LengthBucketBatchSamplerTest(unittest.TestCase):
+    def test_covers_every_index_once(self):
+        lengths = np.random.RandomState(0).randint(3, 60, size=53)
+        sampler = LengthBucketBatchSampler(lengths, batch_size=4, bucket_width=8)
+        for epoch in range(3):
+            sampler.set_epoch(epoch)
+            batches = list(sampler)
+            self.assertEqual(len(batches), len(sampler))
+            self.assertListEqual(sorted(index for batch in batches for index in batch), list(range(len(lengths))))
+
+    def test_equal_batches_per_replica(self):
+        lengths = np.random.RandomState(0).randint(3, 60, size=53)
+        for num_replicas in (2, 3, 5, 7):
+            samplers = [LengthBucketBatchSampler(lengths, batch_size=4, bucket_width=8, num_replicas=num_replicas,
+                                                 rank=rank) for rank in range(num_replicas)]
+            replica_batches = [list(sampler) for sampler in samplers]
+            self.assertEqual(len(set(len(batches) for batches in replica_batches)), 1)
+            self.assertEqual(len(replica_batches[0]), len(samplers[0]))
+            # the replicas together see every example
+            indices = set(index for batches in replica_batches for batch in batches for index in batch)
+            self.assertSetEqual(indices, set(range(len(lengths))))
+
+    def test_more_replicas_than_batches(self):
+        lengths = [5, 7, 9]
+        num_replicas = 7
+        replica_batches = [list(LengthBucketBatchSampler(lengths, batch_size=2, bucket_width=4,
+                                                         num_replicas=num_replicas, rank=rank))
+                           for rank in range(num_replicas)]
+        for batches in replica_batches:
+            self.assertEqual(len(batches), 1)
+
+
+class CollateTrimmedBatchTest(unittest.TestCase):
+    def test_root_is_reindexed(self):
+        max_seq_length = 16
+        batch = []
+        for num_tokens in (3, 5):
+            inputs = torch.zeros(3, max_seq_length, dtype=torch.long)
+            # [CLS] tokens [SEP], then padding and ROOT in the last column
+            inputs[0, :num_tokens + 2] = torch.arange(1, num_tokens + 3)
+            inputs[0, -1] = 99
+            inputs[1, :num_tokens + 2] = 1
+            inputs[1, -1] = 1
+            heads = torch.full((max_seq_length,), -1, dtype=torch.long)
+            heads[1] = max_seq_length - 1
+            heads[2:num_tokens + 1] = 1
+            batch.append((inputs, heads))
+
+        inputs, heads, position_ids = collate_trimmed_batch(batch, pad_to_multiple_of=4)
+        # 7 columns for [CLS] + 5 tokens + [SEP], rounded up to 8 with ROOT
+        self.assertListEqual(list(inputs.size()), [2, 3, 8])
+        self.assertListEqual(inputs[:, 0, -1].tolist(), [99, 99])
+        self.assertListEqual(heads[:, 1].tolist(), [7, 7])
+        self.assertListEqual(heads[1, 2:6].tolist(), [1, 1, 1, 1])
+        self.assertListEqual(position_ids[0].tolist(), [0, 1, 2, 3, 4, 5, 6, max_seq_length - 1])
+        self.assertTrue(position_ids.is_contiguous())
+
+
+if __name__ == "__main__":
+    unittest.main()